@@ -4,39 +4,84 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import multiprocessing
 import os
 import re
+import shutil
+import sys
 import tempfile
+import threading
+import time
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple, List, Dict
-from urllib.parse import urlparse
+from types import MappingProxyType
+from typing import AsyncIterator, Optional, Tuple, List, Dict
+from urllib.parse import quote
 
 # NOTE: We LAZY-import aiogram inside setup_bot() to avoid importing `ssl`
 # on environments where Python was built without it. This lets self-tests run
 # and shows a clear error at runtime instead of crashing at import time.
 
 from dotenv import load_dotenv
-import yt_dlp
-from yt_dlp.utils import DownloadError
 import requests
+from requests.adapters import HTTPAdapter
+
+# yt_dlp is imported inside the helpers that use it: it is heavy, and the
+# bot process itself only needs it once a link is actually processed.
+
+load_dotenv()
 
 # ---------------- configuration ----------------
 BATCH_SIZE = 10         # /getall: make one ZIP after every N downloaded videos
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_MB") or "2048") * 1024 * 1024  # ...or once a batch reaches this size
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY") or "3")  # parallel yt-dlp downloads in bulk modes
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY") or "2")  # batch ZIPs zipped/uploaded at once in bulk modes
+# SPEED_PROFILE presets: fragments fetched in parallel per download. The fragment size
+# itself is not tunable: the "dashy" format mode fixes it at 10 MiB per range request.
+SPEED_PROFILES = {"conservative": 3, "balanced": 8, "aggressive": 16}
+_SPEED = SPEED_PROFILES.get((os.getenv("SPEED_PROFILE") or "balanced").lower(), SPEED_PROFILES["balanced"])
+YTDLP_FRAGMENTS = int(os.getenv("YTDLP_FRAGMENTS") or _SPEED)  # explicit env beats the profile
 DEFAULT_HEIGHT = 0      # 0 => MAX quality by default (always MAX as per requirements)
 ALLOWED_NETLOC = {"youtube.com", "www.youtube.com", "youtu.be", "m.youtube.com"}
 PIXEL_API = "https://pixeldrain.com/api/file"
 PIXEL_VIEW = "https://pixeldrain.com/u/"
 PIXEL_DL   = "https://pixeldrain.com/api/file/"
 PIXEL_API_KEY = os.getenv("PIXELDRAIN_API_KEY") or os.getenv("PIXEL_API_KEY")
+PIXEL_LIST_API = "https://pixeldrain.com/api/list"
+PIXEL_LIST_VIEW = "https://pixeldrain.com/l/"
+PIXEL_USE_LIST = os.getenv("PIXEL_USE_LIST") == "1"  # bulk: upload videos one by one into a PixelDrain list, no ZIP
+PIXEL_LIST_UPLOADS = 4  # list mode: max video uploads in flight, across all batches
+ZIP_COPY_BUFSIZE = 1 << 20  # block size when copying videos into batch ZIPs
+TG_API_SERVER = os.getenv("TG_API_SERVER")  # Local Bot API server base URL, e.g. http://localhost:8081
+# Bot API upload limit: 50 MB on api.telegram.org, 2000 MB through a Local Bot API server
+TG_MAX_UPLOAD = (2000 if TG_API_SERVER else 50) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1 << 20  # read size for uploads: Telegram FSInputFile (aiogram default 64 KiB) and PixelDrain
+TG_GLOBAL_RATE = 30     # Bot API: max outgoing calls per second, bot-wide
+TG_GROUP_RATE = 20      # Bot API: max messages per minute into one group chat
+TG_FILE_ID_CACHE = 1024  # max remembered Telegram file_ids for re-sent singles
+WORK_TMPDIR = os.getenv("WORK_TMPDIR") or None  # parent for download/ZIP dirs, e.g. a tmpfs mount; default: system temp
+LISTING_CACHE_TTL = 600  # seconds a channel/playlist listing is reused by bulk modes
+PIXEL_LINK_TTL = 24 * 3600  # seconds a PixelDrain link for an oversized single is re-sent instead of re-downloading
+ENRICH_CONCURRENCY = 8   # top20: parallel view_count lookups when the listing lacks them
+PROGRESS_INTERVAL = 2.0  # bulk modes: min seconds between edits of the status message
+MAX_ERRORS_SHOWN = 20    # bulk modes: failed items listed in the final summary
 # ------------------------------------------------
 
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise SystemExit("Please set BOT_TOKEN environment variable (e.g., in .env)")
 
+# How bulk results are delivered, as described in GUIDE_TEXT / START_TEXT
+_BULK_PACKING = (
+    f"списки PixelDrain до {BATCH_SIZE} відео" if PIXEL_USE_LIST
+    else f"ZIP-архіви до {BATCH_SIZE} відео на PixelDrain"
+)
+
 # Guide text (no multiline literals inside handlers)
 GUIDE_TEXT = "\n".join([
     "<b>YT-DLP Telegram Bot — Guide</b>",
@@ -44,15 +89,44 @@ GUIDE_TEXT = "\n".join([
     "Бот завжди качає у максимально можливій якості (MAX).",
     "",
     "Меню: кнопками можна обрати режим — одне відео, всі/останні N, топ-20 за переглядами, увесь плейліст.",
-    "При пакетах бот архівує кожні 10 відео і вантажить ZIP на PixelDrain та дає лінки.",
+    f"При пакетах бот вантажить відео як {_BULK_PACKING} і дає лінки.",
 ])
 
+# /start menu description, built once
+START_TEXT = "\n".join([
+    "Можемо скачати:",
+    "",
+    "• 📹 одне відео — попрошу лінк на відео і відправлю файл у Телеграм (якщо надто великий — лінк на PixelDrain)",
+    f"• 📺 всі відео з каналу — лінк на канал, {_BULK_PACKING}",
+    f"• 🆕 останні 10 / 20 / 30 — лінк на канал, {_BULK_PACKING}",
+    f"• 🔥 топ-20 за переглядами — лінк на канал, {_BULK_PACKING}",
+    f"• 🎞 увесь плейліст — лінк на плейліст, {_BULK_PACKING}",
+    "",
+    "Якість: завжди максимально доступна.",
+])
+
+# Link prompt per menu button (cb_mode); every "mode:latest:N" uses CHANNEL_PROMPT
+CHANNEL_PROMPT = "Кинь лінк на канал YouTube (сторінка /videos)"
+MODE_PROMPTS = {
+    "mode:single": "Кинь лінк на відео YouTube",
+    "mode:all": CHANNEL_PROMPT,
+    "mode:top20": CHANNEL_PROMPT,
+    "mode:playlist_all": "Кинь лінк на плейліст YouTube",
+}
+
 YTDLP_COMMON: Dict[str, object] = {
     "outtmpl": "%(title).80s.%(ext)s",
     "noplaylist": True,
     "quiet": True,
     "no_warnings": True,
-    "concurrent_fragment_downloads": 5,
+    "concurrent_fragment_downloads": YTDLP_FRAGMENTS,
+    "buffersize": 1024 * 1024,
+    "retries": 10,
+    "fragment_retries": 10,
+    "file_access_retries": 5,
+    "socket_timeout": 30,
+    # Only YouTube links are accepted, so skip probing the other ~1800 extractors per URL
+    "allowed_extractors": ["youtube.*"],
     # Headers and extractor args reduce 403 and format issues
     "http_headers": {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
@@ -62,28 +136,68 @@ YTDLP_COMMON: Dict[str, object] = {
     "extractor_args": {
         "youtube": {
             "player_client": ["android", "web_safari", "web"],
+            # plain https formats as 10 MiB range fragments, so concurrent_fragment_downloads applies
+            "formats": ["dashy"],
         }
     },
 }
 
+
+def _freeze(value):
+    """Read-only deep copy: dicts become MappingProxyType, lists become tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    """Plain, independent deep copy of a _freeze()d value (yt-dlp expects dicts/lists)."""
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+# Read-only at every level from here on (http_headers, extractor_args included):
+# callers take _ytdlp_opts() and override keys in their own copy, so no code path
+# can change the options every later download starts from.
+YTDLP_COMMON = _freeze(YTDLP_COMMON)
+
+
+def _ytdlp_opts() -> Dict[str, object]:
+    """Fresh mutable copy of YTDLP_COMMON, nested dicts and lists included."""
+    return _thaw(YTDLP_COMMON)
+
 @dataclass
 class DLResult:
     path: Path
     title: str
     ext: str
+    size: int = 0  # bytes, stat'ed once in the worker that produced the file
 
 
 # ---------------- utilities ----------------
 
+# scheme + host (ALLOWED_NETLOC or any subdomain of it) + optional port, anchored at the host end
+_YT_URL_RE = re.compile(
+    r"^https?://(?:[a-z0-9-]+\.)*(?:" + "|".join(re.escape(d) for d in sorted(ALLOWED_NETLOC)) + r")(?::\d+)?(?:[/?#]|$)",
+    re.IGNORECASE,
+)
+
+
 def is_youtube_url(url: str) -> bool:
-    try:
-        netloc = urlparse(url).netloc.lower()
-        return any(netloc.endswith(d) for d in ALLOWED_NETLOC)
-    except Exception:
-        return False
+    return _YT_URL_RE.match(url) is not None
 
 
 def _normalize_watch_url(entry: dict) -> Optional[str]:
+    # Flat video entries carry the id: build the canonical watch URL straight from it
+    # (also turns /shorts/<id> links into plain watch URLs)
+    vid = entry.get("id")
+    if vid and entry.get("ie_key") == "Youtube":
+        return "https://www.youtube.com/watch?v=" + str(vid)
     url = entry.get("webpage_url") or entry.get("url") or ""
     if not url:
         return None
@@ -92,8 +206,11 @@ def _normalize_watch_url(entry: dict) -> Optional[str]:
     return url
 
 
+_UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9._ -]+")
+
+
 def _safe_stem(name: str) -> str:
-    s = re.sub(r"[^A-Za-z0-9._ -]+", "_", (name or "file")).strip()
+    s = _UNSAFE_CHARS_RE.sub("_", (name or "file")).strip()
     return s or "file"
 
 
@@ -115,18 +232,51 @@ def _build_format_string(mode: str, height: int) -> str:
     return "bv*+ba/b"
 
 
-def ytdlp_download(url: str, mode: str, height: int, workdir: Path) -> DLResult:
-    """Blocking download with robust format fallbacks. Called via asyncio.to_thread."""
-    opts = dict(YTDLP_COMMON)
-    opts["paths"] = {"home": str(workdir)}
+def _download_opts(mode: str, height: int) -> Dict[str, object]:
+    opts = _ytdlp_opts()
     opts["merge_output_format"] = "mp4"
     opts["format"] = _build_format_string(mode, height)
+    return opts
+
+
+_YDL_LOCAL = threading.local()
+
+
+def _download_ydl(mode: str, height: int) -> "yt_dlp.YoutubeDL":
+    """Per-thread YoutubeDL for (mode, height), reused across downloads.
+
+    Building a YoutubeDL registers extractors and sets up the HTTP session,
+    so reuse keeps that work (and keep-alive connections) warm across bulk
+    items. Instances are not reentrant, hence one set per worker thread.
+    """
+    import yt_dlp
+
+    cache = getattr(_YDL_LOCAL, "cache", None)
+    if cache is None:
+        cache = _YDL_LOCAL.cache = {}
+    key = (mode, height)
+    ydl = cache.get(key)
+    if ydl is None:
+        ydl = cache[key] = yt_dlp.YoutubeDL(_download_opts(mode, height))
+    return ydl
+
+
+def ytdlp_download(url: str, mode: str, height: int, workdir: Path) -> DLResult:
+    """Blocking download with robust format fallbacks. Runs in a worker process via run_ytdlp()."""
+    import yt_dlp
+    from yt_dlp.utils import DownloadError
+
+    ydl = _download_ydl(mode, height)
+    ydl.params["paths"] = {"home": str(workdir)}
 
     try:
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        info = ydl.extract_info(url, download=True)
     except DownloadError as e:
+        # don't keep reusing an instance whose state a failed run may have left broken
+        _YDL_LOCAL.cache.pop((mode, height), None)
         msg = str(e)
+        opts = _download_opts(mode, height)
+        opts["paths"] = {"home": str(workdir)}
         if "Requested format is not available" in msg:
             opts2 = dict(opts)
             opts2["format"] = "b/best" if mode != "audio" else "ba/bestaudio/best"
@@ -134,43 +284,253 @@ def ytdlp_download(url: str, mode: str, height: int, workdir: Path) -> DLResult:
                 info = y2.extract_info(url, download=True)
         elif "HTTP Error 403" in msg or "Forbidden" in msg:
             opts3 = dict(opts)
-            opts3["extractor_args"] = {"youtube": {"player_client": ["android"]}}
+            opts3["extractor_args"] = {"youtube": {"player_client": ["android"], "formats": ["dashy"]}}
             with yt_dlp.YoutubeDL(opts3) as y3:
                 info = y3.extract_info(url, download=True)
         else:
             raise
+    except Exception:
+        _YDL_LOCAL.cache.pop((mode, height), None)
+        raise
 
     if "requested_downloads" in info and info["requested_downloads"]:
         fn = Path(info["requested_downloads"][0]["filepath"])
     else:
         suffix = ".mp3" if mode == "audio" else ".mp4"
-        with yt_dlp.YoutubeDL(opts) as ytmp:
-            fn = Path(ytmp.prepare_filename(info)).with_suffix(suffix)
+        fn = Path(ydl.prepare_filename(info)).with_suffix(suffix)
     title = info.get("title", fn.stem)
-    return DLResult(path=fn, title=title, ext=fn.suffix.lstrip("."))
+    size = fn.stat().st_size if fn.exists() else 0
+    return DLResult(path=fn, title=title, ext=fn.suffix.lstrip("."), size=size)
+
+
+_YTDLP_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def _ytdlp_pool() -> ProcessPoolExecutor:
+    global _YTDLP_POOL
+    if _YTDLP_POOL is None:
+        # spawn, not fork: workers must not inherit the bot's event loop and open sockets
+        _YTDLP_POOL = ProcessPoolExecutor(
+            max_workers=DOWNLOAD_CONCURRENCY,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _YTDLP_POOL
+
+
+def _in_worker(func, *args):
+    """Pool-side wrapper: re-raise failures as a plain RuntimeError(str(e)).
+
+    yt-dlp's DownloadError keeps exc_info (with a traceback), which can't be
+    pickled back to the parent; the parent would only see "cannot pickle
+    'traceback' object" instead of the real error text.
+    """
+    try:
+        return func(*args)
+    except Exception as e:
+        raise RuntimeError(str(e)) from None
+
+
+def _reset_ytdlp_pool(broken: ProcessPoolExecutor) -> None:
+    global _YTDLP_POOL
+    if _YTDLP_POOL is broken:  # another job may already have replaced it
+        _YTDLP_POOL = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_ytdlp(func, *args):
+    """Run a blocking yt-dlp job in the process pool so extractor/postprocessor
+    Python work doesn't contend for the bot process's GIL.
+
+    A worker that dies (e.g. OOM-killed mid-merge) breaks the whole executor;
+    it is then replaced and the job retried once on the fresh pool.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = _ytdlp_pool()
+        try:
+            return await loop.run_in_executor(pool, _in_worker, func, *args)
+        except BrokenProcessPool:
+            _reset_ytdlp_pool(pool)
+            if attempt:
+                raise RuntimeError("yt-dlp worker process died (out of memory?)") from None
+
+
+# download errors that mean "slow down" rather than "this video is broken". No 403:
+# ytdlp_download has already retried it with the android client by the time it gets
+# here, so what remains is almost always specific to that one video.
+_THROTTLE_MARKERS = (
+    "HTTP Error 429", "Too Many Requests",
+    "HTTP Error 500", "HTTP Error 502", "HTTP Error 503", "HTTP Error 504",
+    "timed out",
+)
+
+
+def _is_throttle_error(exc: BaseException) -> bool:
+    msg = str(exc)
+    return any(m in msg for m in _THROTTLE_MARKERS)
+
+
+class _AdaptiveLimit:
+    """AIMD concurrency limit for bulk downloads (one per do_bulk run).
+
+    Starts at 'maximum'; a throttling failure halves the limit, and each run of
+    'limit' consecutive successes raises it by one again, so parallelism backs
+    off while YouTube is rate-limiting us and recovers once it stops.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = self.maximum
+        self._active = 0
+        self._streak = 0
+        self._cond = asyncio.Condition()
+
+    def _adjust(self, throttled: bool) -> None:
+        if throttled:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._streak = 0
+            return
+        self._streak += 1
+        if self._streak >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._streak = 0
+
+    async def acquire(self) -> None:
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def release(self, throttled: bool = False) -> None:
+        async with self._cond:
+            self._active -= 1
+            self._adjust(throttled)
+            self._cond.notify_all()
 
 
 # ---------------- PixelDrain upload helpers ----------------
 
-def upload_pixeldrain(path: Path) -> Tuple[str, str]:
-    auth = ("user", PIXEL_API_KEY) if PIXEL_API_KEY else None
+class _UploadAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send file bodies in UPLOAD_CHUNK_SIZE blocks
+    rather than urllib3/http.client's default 8-16 KiB reads per send."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["blocksize"] = UPLOAD_CHUNK_SIZE
+        super().init_poolmanager(*args, **kwargs)
+
+
+_HTTP_LOCAL = threading.local()
+
+
+def _pixel_session() -> requests.Session:
+    """Per-thread requests.Session, so uploads reuse a warm keep-alive TLS connection
+    to PixelDrain instead of handshaking for every batch."""
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        session = _HTTP_LOCAL.session = requests.Session()
+        session.mount("https://", _UploadAdapter())
+        if PIXEL_API_KEY:
+            session.auth = ("user", PIXEL_API_KEY)
+    return session
+
+
+def _upload_pixeldrain_id(path: Path) -> str:
+    # PUT /api/file/{name} takes the raw file as the body: requests streams it from
+    # disk with a Content-Length, where a multipart POST builds the whole body in memory
     with open(path, "rb") as f:
-        r = requests.post(PIXEL_API, files={"file": (path.name, f)}, auth=auth, timeout=120)
+        r = _pixel_session().put(PIXEL_API + "/" + quote(path.name), data=f, timeout=120)
     r.raise_for_status()
     data = r.json()
     fid = str(data.get("id") or "")
     if not fid:
         raise RuntimeError("PixelDrain: no id in response")
+    return fid
+
+
+def upload_pixeldrain(path: Path) -> Tuple[str, str]:
+    fid = _upload_pixeldrain_id(path)
     view = PIXEL_VIEW + fid
     direct = PIXEL_DL + fid
     return view, direct
 
 
+_PIXEL_UPLOAD_POOL: Optional[ThreadPoolExecutor] = None
+
+
+def _pixel_upload_pool() -> ThreadPoolExecutor:
+    """Dedicated threads for list-mode uploads: bounds how many run at once and keeps
+    them from starving the default executor (ZIP builds, cleanup, select_urls)."""
+    global _PIXEL_UPLOAD_POOL
+    if _PIXEL_UPLOAD_POOL is None:
+        _PIXEL_UPLOAD_POOL = ThreadPoolExecutor(max_workers=PIXEL_LIST_UPLOADS, thread_name_prefix="pixeldrain")
+    return _PIXEL_UPLOAD_POOL
+
+
+def create_pixeldrain_list(title: str, file_ids: List[str]) -> Tuple[str, str]:
+    """Group uploaded files into one PixelDrain list; returns (list page, whole-list ZIP link)."""
+    body = {"title": title, "anonymous": not PIXEL_API_KEY, "files": [{"id": fid} for fid in file_ids]}
+    r = _pixel_session().post(PIXEL_LIST_API, json=body, timeout=60)
+    r.raise_for_status()
+    lid = str(r.json().get("id") or "")
+    if not lid:
+        raise RuntimeError("PixelDrain: no list id in response")
+    return PIXEL_LIST_VIEW + lid, PIXEL_LIST_API + "/" + lid + "/zip"
+
+
 # ---------------- list & selection helpers ----------------
 
-def list_entries_with_meta(url: str) -> List[Dict[str, object]]:
-    """Return list of entries with url, timestamp, view_count when available (no download)."""
-    opts = dict(YTDLP_COMMON)
+class _TTLCache:
+    """Small thread-safe LRU with per-entry expiry (select_urls runs in worker threads)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            if time.monotonic() - hit[0] > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return hit[1]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# channel/playlist listings are the slowest step of bulk modes; reuse them for a while
+_LISTING_CACHE = _TTLCache(maxsize=256, ttl=LISTING_CACHE_TTL)
+
+
+def list_entries_with_meta(url: str, limit: Optional[int] = None) -> List[Dict[str, object]]:
+    """Return list of entries with url, timestamp, view_count when available (no download).
+
+    With 'limit', yt-dlp stops paging the playlist/channel after that many entries.
+    Results are cached per (url, limit) for LISTING_CACHE_TTL seconds.
+    """
+    key = (url.rstrip("/"), limit or -1)
+    cached = _LISTING_CACHE.get(key)
+    if cached is None:
+        cached = _list_entries_uncached(url, limit)
+        if cached:
+            _LISTING_CACHE.put(key, cached)
+    # per-entry copies: callers (select_urls' top20 enrichment) write into the entries
+    return [dict(e) for e in cached]
+
+
+def _list_entries_uncached(url: str, limit: Optional[int]) -> List[Dict[str, object]]:
+    import yt_dlp
+
+    opts = _ytdlp_opts()
     opts.update({
         "noplaylist": False,
         "extract_flat": "in_playlist",
@@ -178,7 +538,14 @@ def list_entries_with_meta(url: str) -> List[Dict[str, object]]:
         "quiet": True,
         "no_warnings": True,
     })
-    entries: List[Dict[str, object]] = []
+    # flat channel entries then carry an (approximate) timestamp next to view_count,
+    # so 'latest'/'top20' can usually rank without fetching every video page
+    opts["extractor_args"]["youtubetab"] = {"approximate_date": ["timestamp"]}
+    if limit:
+        opts["lazy_playlist"] = True
+        opts["playlist_items"] = "1:" + str(limit)
+    # keyed by watch URL: drops repeated entries while keeping listing order
+    entries: Dict[str, Dict[str, object]] = {}
     with yt_dlp.YoutubeDL(opts) as ydl:
         info = ydl.extract_info(url, download=False)
         raw = info.get("entries") or []
@@ -186,7 +553,7 @@ def list_entries_with_meta(url: str) -> List[Dict[str, object]]:
             if not isinstance(e, dict):
                 continue
             w = _normalize_watch_url(e)
-            if not w:
+            if not w or w in entries:
                 continue
             # try to collect view_count and timestamp
             vc = e.get("view_count")
@@ -198,52 +565,83 @@ def list_entries_with_meta(url: str) -> List[Dict[str, object]]:
                     ts = int(ud)
                 except Exception:
                     ts = None
-            entries.append({
+            entries[w] = {
                 "url": w,
                 "view_count": vc if isinstance(vc, int) else None,
                 "timestamp": ts if isinstance(ts, int) else None,
-            })
-    return entries
+            }
+    return list(entries.values())
+
+
+_INFO_LOCAL = threading.local()
+_ENRICH_POOL: Optional[ThreadPoolExecutor] = None
+_ENRICH_POOL_LOCK = threading.Lock()  # select_urls runs in worker threads, possibly several at once
+
+
+def _enrich_pool() -> ThreadPoolExecutor:
+    """Long-lived lookup threads, so each keeps its _info_ydl() across top20 requests."""
+    global _ENRICH_POOL
+    with _ENRICH_POOL_LOCK:
+        if _ENRICH_POOL is None:
+            _ENRICH_POOL = ThreadPoolExecutor(max_workers=ENRICH_CONCURRENCY, thread_name_prefix="enrich")
+        return _ENRICH_POOL
+
+
+def _info_ydl() -> "yt_dlp.YoutubeDL":
+    """Per-thread metadata-only YoutubeDL, reused across enrich_view_counts lookups."""
+    ydl = getattr(_INFO_LOCAL, "ydl", None)
+    if ydl is None:
+        import yt_dlp
+
+        opts = _ytdlp_opts()
+        opts.update({"skip_download": True, "quiet": True, "no_warnings": True, "noplaylist": True})
+        ydl = _INFO_LOCAL.ydl = yt_dlp.YoutubeDL(opts)
+    return ydl
+
+
+# per-video view counts from enrich_view_counts, reused across top20 runs
+_VIEWS_CACHE = _TTLCache(maxsize=4096, ttl=LISTING_CACHE_TTL)
+
+
+def _fetch_view_count(url: str) -> Optional[int]:
+    cached = _VIEWS_CACHE.get(url)
+    if cached is not None:
+        return cached
+    try:
+        # process=False: view_count comes from the extractor, no format selection needed
+        info = _info_ydl().extract_info(url, download=False, process=False)
+    except Exception:
+        return None
+    vc = info.get("view_count") if isinstance(info, dict) else None
+    if not isinstance(vc, int):
+        return None
+    _VIEWS_CACHE.put(url, vc)
+    return vc
 
 
 def enrich_view_counts(urls: List[str], limit: int = 200) -> Dict[str, int]:
-    """Fetch view_count for up to 'limit' URLs (skip_download). Returns dict url->views."""
-    opts = dict(YTDLP_COMMON)
-    opts.update({"skip_download": True, "quiet": True, "no_warnings": True, "noplaylist": True})
-    views: Dict[str, int] = {}
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        for u in urls[:limit]:
-            try:
-                info = ydl.extract_info(u, download=False)
-                vc = info.get("view_count")
-                if isinstance(vc, int):
-                    views[u] = vc
-            except Exception:
-                continue
-    return views
+    """Fetch view_count for up to 'limit' URLs (skip_download). Returns dict url->views.
+
+    Lookups are independent page fetches, so ENRICH_CONCURRENCY of them run at once.
+    """
+    urls = urls[:limit]
+    counts = list(_enrich_pool().map(_fetch_view_count, urls))
+    return {u: vc for u, vc in zip(urls, counts) if vc is not None}
 
 
 def select_urls(mode: str, src_url: str) -> List[str]:
     """mode: 'all', 'latest:10/20/30', 'top20', 'playlist_all'"""
-    items = list_entries_with_meta(src_url)
+    # channel /videos tabs list newest first, so 'latest:N' only needs the first N entries
+    limit = int(mode.split(":", 1)[1]) if mode.startswith("latest:") else None
+    items = list_entries_with_meta(src_url, limit=limit)
     if not items:
         return []
     if mode == "all" or mode == "playlist_all":
         return [it["url"] for it in items]
     if mode.startswith("latest:"):
-        n = int(mode.split(":", 1)[1])
-        # sort by timestamp desc, fallback to original order
-        items2 = [it for it in items if it.get("timestamp") is not None]
-        items2.sort(key=lambda x: int(x.get("timestamp") or 0), reverse=True)
-        if len(items2) < n:
-            # pad with remaining in original order
-            seen = set(u["url"] for u in items2)
-            for it in items:
-                if it["url"] not in seen:
-                    items2.append(it)
-                    if len(items2) >= n:
-                        break
-        return [it["url"] for it in items2[:n]]
+        # one stable sort: dated entries newest first, then undated ones in listing order
+        items.sort(key=lambda x: (x.get("timestamp") is None, -int(x.get("timestamp") or 0)))
+        return [it["url"] for it in items[:limit]]
     if mode == "top20":
         # try sort by available view_count, enrich if needed
         with_v = [it for it in items if isinstance(it.get("view_count"), int)]
@@ -263,13 +661,21 @@ def select_urls(mode: str, src_url: str) -> List[str]:
 # ---------------- archiving ----------------
 
 def make_zip_single(files: List[Tuple[Path, str]], outdir: Path, batch_idx: int) -> Path:
-    zpath = outdir / ("batch_" + str(batch_idx).zfill(3) + ".zip")
-    zf = zipfile.ZipFile(zpath, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+    zpath = outdir / f"batch_{batch_idx:03d}.zip"
+    # Members are already-compressed video, so STORE them: deflate would burn CPU
+    # for ~0% gain. Copy in large blocks rather than zf.write()'s 8 KiB reads.
+    zf = zipfile.ZipFile(zpath, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
     for p, title in files:
         if not p.exists():
             continue
         arcname = _safe_stem(title) + p.suffix.lower()
-        zf.write(p, arcname=arcname)
+        info = zipfile.ZipInfo.from_file(p, arcname=arcname)
+        info.compress_type = zipfile.ZIP_STORED
+        with open(p, "rb") as src, zf.open(info, "w", force_zip64=True) as dst:
+            if hasattr(os, "posix_fadvise"):
+                # one front-to-back read: let the kernel read ahead aggressively
+                os.posix_fadvise(src.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            shutil.copyfileobj(src, dst, ZIP_COPY_BUFSIZE)
     zf.close()
     return zpath
 
@@ -297,8 +703,37 @@ def setup_bot():
     from aiogram.fsm.state import State, StatesGroup
     from aiogram.fsm.context import FSMContext
     from aiogram.fsm.storage.memory import MemoryStorage
-
-    bot = Bot(BOT_TOKEN)
+    from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+    from aiolimiter import AsyncLimiter
+
+    class RateLimitMiddleware(BaseRequestMiddleware):
+        """Token buckets in front of every Bot API call instead of fixed sleeps."""
+
+        def __init__(self) -> None:
+            self.global_lim = AsyncLimiter(TG_GLOBAL_RATE, 1)
+            # per-group buckets; one idle for over its 60 s window is full again,
+            # so expiring it loses nothing and keeps the map bounded
+            self.group_lims = _TTLCache(maxsize=1024, ttl=120)
+
+        async def __call__(self, make_request, bot, method):
+            chat_id = getattr(method, "chat_id", None)
+            if isinstance(chat_id, int) and chat_id < 0:
+                lim = self.group_lims.get(chat_id)
+                if lim is None:
+                    lim = AsyncLimiter(TG_GROUP_RATE, 60)
+                self.group_lims.put(chat_id, lim)  # refresh expiry on every use
+                await lim.acquire()
+            async with self.global_lim:
+                return await make_request(bot, method)
+
+    session = None
+    if TG_API_SERVER:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TG_API_SERVER, is_local=True))
+    bot = Bot(BOT_TOKEN, session=session)
+    bot.session.middleware(RateLimitMiddleware())
     dp = Dispatcher(storage=MemoryStorage())
 
     # Keyboards
@@ -318,18 +753,7 @@ def setup_bot():
 
     # Handlers (registered programmatically — no decorators at import time)
     async def cmd_start(message: Message):
-        text = "\n".join([
-            "Можемо скачати:",
-            "",
-            "• 📹 одне відео — попрошу лінк на відео і відправлю файл у Телеграм (якщо надто великий — лінк на PixelDrain)",
-            "• 📺 всі відео з каналу — лінк на канал, архівація по 10 і завантаження на PixelDrain",
-            "• 🆕 останні 10 / 20 / 30 — лінк на канал, архівація по 10 і завантаження на PixelDrain",
-            "• 🔥 топ-20 за переглядами — лінк на канал, архівація по 10 і завантаження на PixelDrain",
-            "• 🎞 увесь плейліст — лінк на плейліст, архівація по 10 і завантаження на PixelDrain",
-            "",
-            "Якість: завжди максимально доступна.",
-        ])
-        await message.answer(text, reply_markup=menu_kb())
+        await message.answer(START_TEXT, reply_markup=menu_kb())
 
     async def cmd_help(message: Message):
         await message.answer(GUIDE_TEXT, parse_mode=ParseMode.HTML, reply_markup=menu_kb())
@@ -337,16 +761,11 @@ def setup_bot():
     async def cb_mode(call: CallbackQuery, state: FSMContext):
         data = call.data  # e.g. mode:latest:20
         await state.update_data(sel=data)
-        if data == "mode:single":
-            await call.message.answer("Кинь лінк на відео YouTube")
-        elif data == "mode:all":
-            await call.message.answer("Кинь лінк на канал YouTube (сторінка /videos)")
-        elif data.startswith("mode:latest:"):
-            await call.message.answer("Кинь лінк на канал YouTube (сторінка /videos)")
-        elif data == "mode:top20":
-            await call.message.answer("Кинь лінк на канал YouTube (сторінка /videos)")
-        elif data == "mode:playlist_all":
-            await call.message.answer("Кинь лінк на плейліст YouTube")
+        prompt = MODE_PROMPTS.get(data)
+        if prompt is None and data.startswith("mode:latest:"):
+            prompt = CHANNEL_PROMPT
+        if prompt:
+            await call.message.answer(prompt)
         await state.set_state(AwaitLink.waiting_for_link)
         await call.answer()
 
@@ -364,18 +783,8 @@ def setup_bot():
             await state.clear()
             return
 
-        # Bulk selections
-        if sel == "mode:all":
-            urls = select_urls("all", url)
-        elif sel == "mode:playlist_all":
-            urls = select_urls("playlist_all", url)
-        elif sel.startswith("mode:latest:"):
-            n = sel.split(":")[-1]
-            urls = select_urls("latest:" + n, url)
-        elif sel == "mode:top20":
-            urls = select_urls("top20", url)
-        else:
-            urls = []
+        # Bulk selections: callback data is "mode:" + select_urls() mode (mode:latest:20 -> latest:20)
+        urls = await asyncio.to_thread(select_urls, sel[len("mode:"):], url)
 
         if not urls:
             await message.reply("Не вдалося зібрати список відео. Перевір лінк або спробуй інший режим.")
@@ -395,85 +804,289 @@ def setup_bot():
 
 # ---------------- single & bulk flows ----------------
 
+# Telegram file_id of already-sent singles, keyed by "url|mode|height" -> (kind, file_id, caption).
+# Re-sending by file_id is a metadata-only call: no download, no upload.
+_TG_FILE_IDS: "OrderedDict[str, Tuple[str, str, str]]" = OrderedDict()
+
+
+def _remember_file_id(key: str, kind: str, file_id: str, caption: str) -> None:
+    _TG_FILE_IDS[key] = (kind, file_id, caption)
+    _TG_FILE_IDS.move_to_end(key)
+    while len(_TG_FILE_IDS) > TG_FILE_ID_CACHE:
+        _TG_FILE_IDS.popitem(last=False)
+
+
+def _media_kind(ext: str) -> str:
+    """Telegram send method for a downloaded file: 'video', 'audio' or 'document'."""
+    ext = ext.lower()
+    if ext == "mp4":
+        return "video"
+    if ext in ("mp3", "m4a"):
+        return "audio"
+    return "document"
+
+
+async def _send_media(message, kind: str, media, caption: str, title: str = "") -> Optional[str]:
+    """Send a file (or file_id) as video/audio/document; return the resulting Telegram file_id.
+
+    Videos go out with supports_streaming so clients can start playback before the
+    whole file arrives; audio gets a player with the video title.
+    """
+    if kind == "video":
+        sent = await message.answer_video(media, caption=caption, supports_streaming=True)
+        tg_file = sent.video
+    elif kind == "audio":
+        sent = await message.answer_audio(media, caption=caption, title=title or None)
+        tg_file = sent.audio
+    else:
+        sent = await message.answer_document(media, caption=caption)
+        tg_file = sent.document
+    return tg_file.file_id if tg_file else None
+
+
+@contextlib.asynccontextmanager
+async def _temp_workdir() -> AsyncIterator[Path]:
+    """Async TemporaryDirectory: creation and the final rmtree of possibly
+    multi-GB downloads run in a worker thread, not on the event loop."""
+    td = await asyncio.to_thread(tempfile.mkdtemp, prefix="ytbot_", dir=WORK_TMPDIR)
+    try:
+        yield Path(td)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, td, True)
+
+
+# PixelDrain links of singles too large for Telegram, same keys as _TG_FILE_IDS
+_PIXEL_LINKS = _TTLCache(maxsize=TG_FILE_ID_CACHE, ttl=PIXEL_LINK_TTL)
+
+
+def _pixel_text(view: str, direct: str) -> str:
+    return "Файл великий, залив на PixelDrain:\n" + view + "\nПряма лінка: " + direct
+
+
 async def do_single(message, url: str) -> None:
     # dynamic import to avoid ssl import at module time
     from aiogram.types import FSInputFile
 
+    key = url + "|video|" + str(DEFAULT_HEIGHT)
+    hit = _TG_FILE_IDS.get(key)
+    if hit is not None:
+        _TG_FILE_IDS.move_to_end(key)
+        try:
+            await _send_media(message, hit[0], hit[1], hit[2])
+            return
+        except Exception:
+            # file_id no longer valid: forget it and send a fresh copy
+            _TG_FILE_IDS.pop(key, None)
+
+    links = _PIXEL_LINKS.get(key)
+    if links is not None:
+        await message.answer(_pixel_text(*links))
+        return
+
     await message.reply("Ок, качаю одне відео у максимальній якості…")
-    with tempfile.TemporaryDirectory() as td:
-        workdir = Path(td)
+    async with _temp_workdir() as workdir:
         try:
-            dl = await asyncio.to_thread(ytdlp_download, url, "video", DEFAULT_HEIGHT, workdir)
+            dl = await run_ytdlp(ytdlp_download, url, "video", DEFAULT_HEIGHT, workdir)
         except Exception as e:
             await message.reply("Не вийшло скачати: " + str(e))
             return
+        # Bot API rejects uploads above TG_MAX_UPLOAD only after receiving them —
+        # don't push the whole file to Telegram just to learn that.
+        if dl.size <= TG_MAX_UPLOAD:
+            try:
+                caption = str(dl.title) + " (yt-dlp)"
+                kind = _media_kind(dl.ext)
+                media = FSInputFile(str(dl.path), chunk_size=UPLOAD_CHUNK_SIZE)
+                file_id = await _send_media(message, kind, media, caption, title=str(dl.title))
+                if file_id:
+                    _remember_file_id(key, kind, file_id, caption)
+                return
+            except Exception as e:
+                err = str(e)
+                if not (("Too Large" in err) or ("too big" in err) or ("413" in err)):
+                    await message.reply("Не вдалося надіслати файл: " + err)
+                    return
         try:
-            caption = str(dl.title) + " (yt-dlp)"
-            await message.answer_document(FSInputFile(str(dl.path)), caption=caption)
-        except Exception as e:
-            err = str(e)
-            if ("Too Large" in err) or ("too big" in err) or ("413" in err):
-                try:
-                    view, direct = await asyncio.to_thread(upload_pixeldrain, dl.path)
-                    text = "Файл великий, залив на PixelDrain:\n" + view + "\nПряма лінка: " + direct
-                    await message.answer(text)
-                except Exception as e2:
-                    await message.reply("Не вдалося надіслати файл і завантажити на PixelDrain: " + str(e2))
-            else:
-                await message.reply("Не вдалося надіслати файл: " + err)
+            view, direct = await asyncio.to_thread(upload_pixeldrain, dl.path)
+            _PIXEL_LINKS.put(key, (view, direct))
+            await message.answer(_pixel_text(view, direct))
+        except Exception as e2:
+            await message.reply("Не вдалося надіслати файл і завантажити на PixelDrain: " + str(e2))
+
+
+def _remove_batch_files(files: List[Tuple[Path, str]], outdir: Path) -> None:
+    for p, _ in files:
+        p.unlink(missing_ok=True)
+        if p.parent != outdir:
+            # per-item download dir: remove it with any yt-dlp leftovers
+            shutil.rmtree(p.parent, ignore_errors=True)
+
+
+async def deliver_batch(message, files: List[Tuple[Path, str]], outdir: Path, batch_index: int) -> bool:
+    """Zip one batch, upload it to PixelDrain and post the links. Deletes the batch's
+    files (and their per-item dirs) afterwards whether or not delivery worked.
+    With PIXEL_USE_LIST the videos are uploaded in parallel and grouped into a
+    PixelDrain list instead of being zipped. Returns True on success."""
+    try:
+        failed = 0
+        if PIXEL_USE_LIST:
+            loop = asyncio.get_running_loop()
+            # return_exceptions: every upload has finished before 'finally' deletes the files
+            results = await asyncio.gather(*(
+                loop.run_in_executor(_pixel_upload_pool(), _upload_pixeldrain_id, p)
+                for p, _ in files if p.exists()
+            ), return_exceptions=True)
+            ids = [r for r in results if isinstance(r, str)]
+            errors = [r for r in results if isinstance(r, BaseException)]
+            if not ids:
+                raise errors[0] if errors else RuntimeError("no files to upload")
+            failed = len(errors)
+            view, direct = await asyncio.to_thread(create_pixeldrain_list, f"batch_{batch_index:03d}", ids)
+            count = len(ids)
+        else:
+            # building the ZIP copies the whole batch: keep that disk I/O off the event loop
+            z = await asyncio.to_thread(make_zip_single, files, outdir, batch_index)
+            try:
+                view, direct = await asyncio.to_thread(upload_pixeldrain, z)
+            finally:
+                await asyncio.to_thread(z.unlink, missing_ok=True)
+            count = len(files)
+        text = f"Пакет {batch_index} ({count} відео):\n{view}\nПряма лінка: {direct}"
+        if failed:
+            text += f"\nНе вдалося залити: {failed}"
+        await message.answer(text)
+        return True
+    except Exception as e:
+        what = "пакет" if PIXEL_USE_LIST else "архів"
+        await message.answer(f"Не вдалося завантажити {what} на PixelDrain: {e}")
+        return False
+    finally:
+        await asyncio.to_thread(_remove_batch_files, files, outdir)
 
 
 async def do_bulk(message, urls: List[str]) -> None:
-    await message.reply("Знайшов " + str(len(urls)) + " відео. Пакетую по " + str(BATCH_SIZE) + " у ZIP та вантажу на PixelDrain…")
+    total = len(urls)
+    packing = "у список" if PIXEL_USE_LIST else "у ZIP"
+    await message.reply(f"Знайшов {total} відео. Пакетую по {BATCH_SIZE} {packing} та вантажу на PixelDrain…")
 
-    with tempfile.TemporaryDirectory() as session_td:
-        session_dir = Path(session_td)
+    async with _temp_workdir() as session_dir:
         workdir = session_dir / "items"
         workdir.mkdir(parents=True, exist_ok=True)
 
-        batch_files: List[Tuple[Path, str]] = []
-        batch_index = 1
+        # Producers: up to DOWNLOAD_CONCURRENCY parallel downloads, fewer while
+        # YouTube is throttling (see _AdaptiveLimit). Consumer: one
+        # task that batches finished videos, zips and uploads them. A producer
+        # keeps its download slot until its result is queued, so the bounded
+        # queue also bounds how many finished videos wait on disk.
+        dl_limit = _AdaptiveLimit(DOWNLOAD_CONCURRENCY)
+        ready: "asyncio.Queue[Optional[DLResult]]" = asyncio.Queue(maxsize=BATCH_SIZE)
         processed = 0
-
-        for idx, watch_url in enumerate(urls, 1):
+        downloaded = 0
+        errors: List[str] = []
+
+        # One status message for the whole run, edited at most every PROGRESS_INTERVAL
+        # seconds, instead of a message plus two edits per video.
+        def progress_text() -> str:
+            return f"Скачано {downloaded}/{total}, помилок: {len(errors)}"
+
+        status = await message.answer(progress_text())
+
+        async def progress() -> None:
+            shown = progress_text()
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                text = progress_text()
+                if text != shown:
+                    try:
+                        await status.edit_text(text)
+                        shown = text
+                    except Exception:
+                        pass
+
+        async def producer(idx: int, watch_url: str) -> None:
+            nonlocal downloaded
+            throttled = False
+            await dl_limit.acquire()
             try:
-                note = await message.answer(str(idx) + "/" + str(len(urls)) + " — качаю…")
+                # own subdir per item: parallel downloads of same-titled videos must not collide
+                item_dir = workdir / str(idx)
+                item_dir.mkdir(exist_ok=True)
                 try:
-                    dl = await asyncio.to_thread(ytdlp_download, watch_url, "video", DEFAULT_HEIGHT, workdir)
+                    dl = await run_ytdlp(ytdlp_download, watch_url, "video", DEFAULT_HEIGHT, item_dir)
                 except Exception as e:
-                    await note.edit_text(str(idx) + "/" + str(len(urls)) + " — помилка: " + str(e))
-                    continue
-
+                    throttled = _is_throttle_error(e)
+                    # drop .part leftovers now rather than holding them until the session ends
+                    await asyncio.to_thread(shutil.rmtree, item_dir, True)
+                    errors.append(f"{idx}/{total}: {e}")
+                    return
+                downloaded += 1
+                await ready.put(dl)
+            finally:
+                await dl_limit.release(throttled)
+
+        # Up to UPLOAD_CONCURRENCY batches are delivered in the background while the
+        # consumer keeps draining the queue, so downloads don't stall behind an upload.
+        # Beyond that the consumer waits, which bounds the ZIPs held on disk.
+        upload_sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        uploads: List["asyncio.Task[bool]"] = []
+
+        async def deliver(files: List[Tuple[Path, str]], batch_index: int) -> bool:
+            try:
+                return await deliver_batch(message, files, session_dir, batch_index)
+            finally:
+                upload_sem.release()
+
+        async def flush(files: List[Tuple[Path, str]], batch_index: int) -> None:
+            await upload_sem.acquire()
+            uploads.append(asyncio.create_task(deliver(files, batch_index)))
+
+        async def consumer() -> None:
+            nonlocal processed
+            batch_files: List[Tuple[Path, str]] = []
+            batch_bytes = 0
+            batch_index = 1
+            while (dl := await ready.get()) is not None:
                 batch_files.append((dl.path, dl.title))
+                batch_bytes += dl.size
                 processed += 1
-                await note.edit_text(str(idx) + "/" + str(len(urls)) + " — готово, додано у пакет")
-
-                if len(batch_files) >= BATCH_SIZE:
-                    z = make_zip_single(batch_files, session_dir, batch_index)
-                    try:
-                        view, direct = await asyncio.to_thread(upload_pixeldrain, z)
-                        text = "Пакет " + str(batch_index) + " (" + str(len(batch_files)) + " відео):\n" + view + "\nПряма лінка: " + direct
-                        await message.answer(text)
-                    except Exception as e:
-                        await message.answer("Не вдалося завантажити архів на PixelDrain: " + str(e))
+                if len(batch_files) >= BATCH_SIZE or batch_bytes >= MAX_BATCH_BYTES:
+                    await flush(batch_files, batch_index)
                     batch_files = []
+                    batch_bytes = 0
                     batch_index += 1
+            if batch_files:
+                await flush(batch_files, batch_index)
+            await asyncio.gather(*uploads)
 
-                await asyncio.sleep(0.8)
-            except Exception:
-                continue
-
-        # remaining
-        if batch_files:
-            z = make_zip_single(batch_files, session_dir, batch_index)
-            try:
-                view, direct = await asyncio.to_thread(upload_pixeldrain, z)
-                text = "Пакет " + str(batch_index) + " (" + str(len(batch_files)) + " відео):\n" + view + "\nПряма лінка: " + direct
-                await message.answer(text)
-            except Exception as e:
-                await message.answer("Не вдалося завантажити архів на PixelDrain: " + str(e))
+        consumer_task = asyncio.create_task(consumer())
+        progress_task = asyncio.create_task(progress())
+        try:
+            # TaskGroup: if a producer fails unexpectedly (or the run is cancelled),
+            # the remaining downloads are cancelled instead of left running
+            async with asyncio.TaskGroup() as tg:
+                for idx, u in enumerate(urls, 1):
+                    tg.create_task(producer(idx, u))
+            await ready.put(None)
+            await consumer_task
+        finally:
+            progress_task.cancel()
+            if not consumer_task.done():
+                consumer_task.cancel()
+                # batches already handed to PixelDrain finish their upload (and post
+                # their links) before the session dir is removed under them
+                await asyncio.shield(asyncio.gather(*uploads, return_exceptions=True))
 
-    await message.reply("Готово. Оброблено: " + str(processed) + " з " + str(len(urls)) + ".")
+    try:
+        await status.edit_text(progress_text())
+    except Exception:
+        pass
+    lines = [f"Готово. Оброблено: {processed} з {total}."]
+    if errors:
+        lines.append("Помилки:")
+        lines.extend(err[:200] for err in errors[:MAX_ERRORS_SHOWN])
+        if len(errors) > MAX_ERRORS_SHOWN:
+            lines.append(f"… і ще {len(errors) - MAX_ERRORS_SHOWN}")
+    await message.reply("\n".join(lines))
 
 
 # ---------------- lightweight self-tests --------------------
@@ -484,6 +1097,38 @@ def _selftest() -> None:
     assert "height<=720" in _build_format_string("video", 720), "height filter in format"
     assert _build_format_string("video", 0) == "bv*+ba/b", "MAX quality default"
 
+    # menu texts describe the packing mode actually in use
+    assert ("ZIP" in GUIDE_TEXT) != PIXEL_USE_LIST and ("ZIP" in START_TEXT) != PIXEL_USE_LIST, "packing in texts"
+
+    # shared yt-dlp options stay read-only; per-call copies are independent
+    assert "format" in _download_opts("video", 0) and "format" not in YTDLP_COMMON, "base options untouched"
+    try:
+        YTDLP_COMMON["quiet"] = False  # type: ignore[index]
+        raise AssertionError("YTDLP_COMMON must be read-only")
+    except TypeError:
+        pass
+    try:
+        YTDLP_COMMON["extractor_args"]["youtube"]["player_client"].append("tv")  # type: ignore[index]
+        raise AssertionError("nested YTDLP_COMMON options must be read-only")
+    except (TypeError, AttributeError):
+        pass
+    opts = _download_opts("video", 0)
+    opts["extractor_args"]["youtube"]["player_client"].append("tv")
+    opts["http_headers"]["Referer"] = "x"
+    assert "tv" not in _ytdlp_opts()["extractor_args"]["youtube"]["player_client"], "nested copy is independent"
+    assert _ytdlp_opts()["http_headers"]["Referer"] == "https://www.youtube.com/", "headers copy is independent"
+    assert isinstance(_ytdlp_opts()["allowed_extractors"], list), "yt-dlp gets plain lists back"
+
+    # watch url normalization
+    assert _normalize_watch_url({"ie_key": "Youtube", "id": "abc", "url": "https://www.youtube.com/shorts/abc"}) == "https://www.youtube.com/watch?v=abc"
+    assert _normalize_watch_url({"url": "abc"}) == "https://www.youtube.com/watch?v=abc", "bare id fallback"
+
+    # url validation
+    assert is_youtube_url("https://www.youtube.com/watch?v=abc"), "watch url"
+    assert is_youtube_url("https://youtu.be/abc") and is_youtube_url("HTTPS://M.YOUTUBE.COM/@ch"), "short / mobile url"
+    assert not is_youtube_url("https://notyoutube.com/watch?v=abc"), "lookalike host rejected"
+    assert not is_youtube_url("youtube.com/watch?v=abc"), "scheme required"
+
     # safe stem
     assert _safe_stem("a*b?c").startswith("a_b_c"), "safe stem replaces illegal chars"
     assert _safe_stem("") == "file", "empty stem fallback"
@@ -491,9 +1136,32 @@ def _selftest() -> None:
     # message formatting with \n
     view = "https://pixeldrain.com/u/XYZ"
     direct = "https://pixeldrain.com/api/file/XYZ"
-    txt = "Файл великий, залив на PixelDrain:\n" + view + "\nПряма лінка: " + direct
+    txt = _pixel_text(view, direct)
     assert "\n" in txt and view in txt and direct in txt
 
+    # PixelDrain list: request shape and returned links (session stubbed for this thread)
+    class _FakeResp:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"success": True, "id": "L1"}
+
+    class _FakeSession:
+        def post(self, url, json=None, timeout=None):
+            sent.update(url=url, body=json)
+            return _FakeResp()
+
+    sent: Dict[str, object] = {}
+    _HTTP_LOCAL.session = _FakeSession()
+    try:
+        links = create_pixeldrain_list("batch_001", ["a", "b"])
+    finally:
+        del _HTTP_LOCAL.session
+    assert sent["url"] == "https://pixeldrain.com/api/list", "list endpoint"
+    assert sent["body"]["title"] == "batch_001" and sent["body"]["files"] == [{"id": "a"}, {"id": "b"}], "list payload"
+    assert links == ("https://pixeldrain.com/l/L1", "https://pixeldrain.com/api/list/L1/zip"), "list links"
+
     # selection helpers: synthetic ordering
     items = [
         {"url": "u1", "timestamp": 20240101, "view_count": 10},
@@ -502,15 +1170,93 @@ def _selftest() -> None:
     ]
     latest_sorted = sorted(items, key=lambda x: int(x.get("timestamp") or 0), reverse=True)
     assert [i["url"] for i in latest_sorted][:2] == ["u2", "u3"], "latest ordering"
+    # real select_urls('latest:N') over a listing seeded into the cache (no network)
+    src = "https://www.youtube.com/@selftest_latest/videos"
+    mixed = [{"url": "a"}, {"url": "b", "timestamp": 1}, {"url": "c"}, {"url": "d", "timestamp": 2}, {"url": "e"}]
+    _LISTING_CACHE.put((src, 4), mixed)
+    assert select_urls("latest:4", src) == ["d", "b", "a", "c"], "dated newest first, undated padded in listing order"
     top_sorted = sorted(items, key=lambda x: int(x.get("view_count") or 0), reverse=True)
     assert [i["url"] for i in top_sorted][:2] == ["u2", "u3"], "top ordering"
 
+    # telegram send method per extension
+    assert _media_kind("MP4") == "video" and _media_kind("m4a") == "audio", "media kinds"
+    assert _media_kind("webm") == "document", "other containers go as documents"
+
+    # adaptive download limit: halve on throttling, +1 after 'limit' clean downloads
+    lim = _AdaptiveLimit(4)
+    lim._adjust(throttled=True)
+    assert lim.limit == 2, "multiplicative decrease"
+    lim._adjust(False); lim._adjust(False)
+    assert lim.limit == 3, "additive increase"
+    assert _is_throttle_error(RuntimeError("ERROR: HTTP Error 429: Too Many Requests")), "429 is throttling"
+    assert not _is_throttle_error(RuntimeError("Video unavailable")), "missing video is not throttling"
+    assert not _is_throttle_error(RuntimeError("ERROR: HTTP Error 403: Forbidden")), "403 is per-video, not throttling"
+    assert _is_throttle_error(RuntimeError("ERROR: HTTP Error 503: Service Unavailable")), "5xx is throttling"
+
+    # cached listings hand out copies: a caller's edits don't leak into later callers
+    lkey = ("https://www.youtube.com/@selftest", -1)
+    _LISTING_CACHE.put(lkey, [{"url": "u1", "view_count": None, "timestamp": None}])
+    first = list_entries_with_meta("https://www.youtube.com/@selftest/")
+    first[0]["view_count"] = 5
+    assert list_entries_with_meta("https://www.youtube.com/@selftest")[0]["view_count"] is None, "cached entries not shared"
+
+    # listing cache: LRU eviction and expiry
+    c = _TTLCache(maxsize=2, ttl=60)
+    c.put("a", 1); c.put("b", 2); c.get("a"); c.put("c", 3)
+    assert c.get("b") is None and c.get("a") == 1 and c.get("c") == 3, "ttl cache evicts LRU"
+    c.ttl = -1
+    assert c.get("a") is None, "ttl cache expires entries"
+
+
+def _selftest_failing_job(msg: str) -> None:
+    """Fail the way yt-dlp's DownloadError does: with exc_info (a traceback) attached."""
+    try:
+        raise OSError(msg)
+    except OSError:
+        err = RuntimeError(msg)
+        err.exc_info = sys.exc_info()  # type: ignore[attr-defined]
+        raise err
+
+
+async def _selftest_async() -> None:
+    # a failing job crosses the process pool with its message intact
+    try:
+        await run_ytdlp(_selftest_failing_job, "ERROR: Video unavailable")
+        raise AssertionError("failing pool job must raise")
+    except RuntimeError as e:
+        assert "Video unavailable" in str(e), "worker error text survives the pool: " + str(e)
+
+    # throttling raised inside a worker still classifies as throttling in the parent,
+    # so _AdaptiveLimit actually backs off
+    try:
+        await run_ytdlp(_selftest_failing_job, "ERROR: unable to download video data: HTTP Error 429: Too Many Requests")
+        raise AssertionError("failing pool job must raise")
+    except RuntimeError as e:
+        assert _is_throttle_error(e), "pool-transported 429 is throttling"
+        lim = _AdaptiveLimit(4)
+        await lim.acquire()
+        await lim.release(_is_throttle_error(e))
+        assert lim.limit == 2, "limit halves after a pool-transported 429"
+
+    # a dead worker breaks the pool: it is replaced, and the job fails cleanly once more
+    try:
+        await run_ytdlp(os._exit, 1)
+        raise AssertionError("job in a dying worker must raise")
+    except RuntimeError as e:
+        assert "worker process died" in str(e), "broken pool reported: " + str(e)
+    try:
+        await run_ytdlp(_selftest_failing_job, "still works")
+        raise AssertionError("failing pool job must raise")
+    except RuntimeError as e:
+        assert "still works" in str(e), "pool usable after a worker died: " + str(e)
+
 
 # ---------------- entrypoint ----------------
 
 async def main():
     if os.getenv("SELFTEST") == "1":
         _selftest()
+        await _selftest_async()
         print("SELFTEST passed")
         return
 
@@ -535,6 +1281,13 @@ async def main():
 
 
 if __name__ == "__main__":
+    # uvloop, when installed, gives a faster event loop for socket-heavy polling/uploads
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):